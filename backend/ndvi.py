@@ -0,0 +1,299 @@
+"""
+NDVI computation and heatmap rendering for uploaded GeoTIFFs (tifffile + numpy + PIL, no GDAL).
+Kept apart from server.py so the NDVI process pool's spawned workers import only this module,
+not the app, its environment and the Mongo client.
+"""
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+import logging
+
+import numpy as np
+from PIL import Image
+try:
+    import tifffile
+except Exception:  # pragma: no cover
+    tifffile = None
+
+# Bump on any change to the computed statistics or the heatmap; cached results of older versions
+# are then recomputed instead of being served (see analyze_project)
+NDVI_ALGO_VERSION = 1
+
+def _build_ndvi_lut() -> np.ndarray:
+    # Green ramp over heat in [0,1] (NDVI -1..1), sampled once at 256 levels
+    heat = np.arange(256) / 255.0
+    r = np.interp(heat, [0, 0.5, 1.0], [120, 240, 20])
+    g = np.interp(heat, [0, 0.5, 1.0], [60, 200, 180])
+    b = np.interp(heat, [0, 0.5, 1.0], [20, 80, 40])
+    lut = np.ascontiguousarray(np.stack([r, g, b], axis=-1).astype(np.uint8))
+    # Shared by every call (and built once per pool worker at import); must never be mutated
+    lut.setflags(write=False)
+    return lut
+
+_NDVI_LUT = _build_ndvi_lut()
+
+def _guess_red_nir(shape: tuple) -> Optional[tuple]:
+    """Try to guess (red_idx, nir_idx) given an array shape.
+    Supports: (H,W,4) RGBA-like where channel 0 or 2 is Red and last is NIR;
+              multi-page tiff where pages represent bands and page descriptions contain 'red'/'nir'.
+    Returns (red, nir) channel indices if found within last axis, else None.
+    """
+    if len(shape) == 3:
+        h, w, c = shape
+        if c >= 4:
+            # Try common orders
+            return (2, 3) if c >= 4 else None  # B,G,R,NIR (R=2, NIR=3) is common for some sensors
+        if c >= 3:
+            # If only RGB, we can't produce NDVI reliably
+            return None
+    return None
+
+
+def _read_pixels(source, contiguous: bool) -> np.ndarray:
+    # Uncompressed contiguous data is memory-mapped straight from the file, so only the pages
+    # backing the bands we slice are touched; anything else is decoded in full (see _iter_segment_bands)
+    return source.asarray(out='memmap') if contiguous else source.asarray()
+
+
+def _streamable(page) -> bool:
+    # Tiles/strips can be streamed when every segment carries all samples of a single 2-D plane
+    return page.shaped[0] == 1 and page.shaped[1] == 1
+
+
+# Compressed bytes read per batch when streaming segments; tifffile's default reads far ahead.
+# One decode thread: the pool already runs one NDVI job per worker process.
+_SEGMENT_BUFFER_BYTES = 4 << 20
+
+
+def _iter_segment_bands(red_page, nir_page, red_idx: int = 0, nir_idx: int = 0) -> Iterator[tuple]:
+    """Decode compressed/tiled pages one segment at a time.
+    Yields (y, x, red, nir) with each 2-D band tile cropped to the image; `nir_page` may be
+    `red_page` with the bands picked by sample index.
+    """
+    h, w = red_page.shaped[2], red_page.shaped[3]
+
+    def tiles(page):
+        for data, (_, _, y, x, _), shape in page.segments(buffersize=_SEGMENT_BUFFER_BYTES, maxworkers=1):
+            if data is None:  # empty (sparse) segment
+                data = np.zeros(shape, dtype=page.dtype)
+            yield y, x, data[0, :h - y, :w - x]
+
+    if nir_page is red_page:
+        for y, x, t in tiles(red_page):
+            yield y, x, t[..., red_idx], t[..., nir_idx]
+    else:
+        for (y, x, r), (_, _, n) in zip(tiles(red_page), tiles(nir_page)):
+            yield y, x, r[..., 0], n[..., 0]
+
+
+def _band_scale(peak: float) -> float:
+    # Reflectance stored as 0..10000 (e.g. Sentinel-2 L2A) or 8-bit DN; already-normalized bands pass through
+    if peak > 1.5:
+        return 10000.0 if peak > 100.0 else 255.0
+    return 1.0
+
+
+def _ndvi_into(red: np.ndarray, nir: np.ndarray) -> np.ndarray:
+    """Fused NDVI of normalized float32 bands, written into `nir`'s buffer.
+    Only the denominator needs a temporary.
+    """
+    den = np.add(nir, red)
+    den += 1e-6
+    ndvi = np.subtract(nir, red, out=nir)
+    ndvi /= den
+    np.clip(ndvi, -1.0, 1.0, out=ndvi)
+    return ndvi
+
+
+_NDVI_STRIP_ROWS = 512
+
+
+def _ndvi_sums(red: np.ndarray, nir: np.ndarray, red_scale: float, nir_scale: float) -> tuple:
+    """Full-resolution NDVI sums over raw bands (any dtype, possibly memory-mapped).
+    Works in row strips, so peak memory is a few strips regardless of raster size.
+    Returns (total, valid, healthy) for _ndvi_summary.
+    """
+    total = 0.0
+    valid = 0
+    healthy = 0
+    # Integer bands cannot yield NaN (the denominator carries +eps), so skip the NaN mask for them
+    nan_possible = not (np.issubdtype(red.dtype, np.integer) and np.issubdtype(nir.dtype, np.integer))
+    for y in range(0, red.shape[0], _NDVI_STRIP_ROWS):
+        r = red[y:y + _NDVI_STRIP_ROWS].astype(np.float32)
+        n = nir[y:y + _NDVI_STRIP_ROWS].astype(np.float32)
+        if red_scale != 1.0:
+            r /= red_scale
+        if nir_scale != 1.0:
+            n /= nir_scale
+        ndvi = _ndvi_into(r, n)
+        # Healthy vegetation threshold ~ 0.3
+        healthy += np.count_nonzero(ndvi > 0.3)
+        if nan_possible:
+            finite = ~np.isnan(ndvi)
+            valid += np.count_nonzero(finite)
+            total += float(ndvi.sum(where=finite, dtype=np.float64))
+        else:
+            valid += ndvi.size
+            total += float(ndvi.sum(dtype=np.float64))
+    return total, valid, healthy
+
+
+def _ndvi_summary(total: float, valid: int, healthy: int, size: int) -> tuple:
+    # (mean_ndvi, healthy_pct) from accumulated _ndvi_sums
+    healthy_pct = float(np.round(healthy * 100.0 / size, 1))
+    mean_ndvi = float(np.round(total / valid, 3)) if valid else float('nan')
+    return mean_ndvi, healthy_pct
+
+
+def _preview_step(h: int, w: int) -> int:
+    # Downscale for preview to keep memory light: block-average the bands, then NDVI on the small grid
+    return max(1, int(max(h, w) / 1024))
+
+
+def _block_counts(h: int, w: int, step: int) -> np.ndarray:
+    # Pixels per step x step block over ceil(shape / step) blocks; edge blocks may be partial
+    rows = np.minimum(step, h - np.arange(-(-h // step)) * step).astype(np.float32)
+    cols = np.minimum(step, w - np.arange(-(-w // step)) * step).astype(np.float32)
+    return rows[:, None] * cols[None, :]
+
+
+def _block_mean(band: np.ndarray, step: int) -> np.ndarray:
+    # Average step x step blocks into a new float32 array of ceil(shape / step), like the strided
+    # band[::step, ::step] preview it replaces; partial edge blocks average over the pixels they hold
+    if step == 1:
+        return band.astype(np.float32)
+    h, w = band.shape[0], band.shape[1]
+    # step**2 strided adds beat a reshape().mean() reduction by ~3-10x and allocate only the output
+    out = np.zeros((-(-h // step), -(-w // step)), dtype=np.float32)
+    for i in range(min(step, h)):
+        for j in range(min(step, w)):
+            view = band[i::step, j::step]
+            out[:view.shape[0], :view.shape[1]] += view
+    out /= _block_counts(h, w, step)
+    return out
+
+
+def _add_block_sums(out: np.ndarray, tile: np.ndarray, y: int, x: int, step: int) -> None:
+    # Fold a tile at (y, x) into per-block sums; tiles need not align with blocks, so reduceat
+    # sums the runs of rows/columns that fall into each block
+    if step == 1:
+        out[y:y + tile.shape[0], x:x + tile.shape[1]] += tile
+        return
+    rows = np.r_[0, np.arange((y // step + 1) * step, y + tile.shape[0], step) - y]
+    cols = np.r_[0, np.arange((x // step + 1) * step, x + tile.shape[1], step) - x]
+    sums = np.add.reduceat(np.add.reduceat(tile, rows, axis=0, dtype=np.float32), cols, axis=1)
+    out[y // step:y // step + len(rows), x // step:x // step + len(cols)] += sums
+
+
+def _ndvi_from_bands(red: np.ndarray, nir: np.ndarray) -> tuple:
+    # (ndvi_small, mean_ndvi, healthy_pct) for bands addressable as whole (possibly memory-mapped) arrays.
+    # Normalize to 0..1 if necessary; applied per strip/preview, never to a full-size copy
+    red_scale = _band_scale(red.max())
+    nir_scale = _band_scale(nir.max())
+    step = _preview_step(*red.shape)
+    red_small = _block_mean(red, step)
+    nir_small = _block_mean(nir, step)
+    red_small /= red_scale
+    nir_small /= nir_scale
+    ndvi_small = _ndvi_into(red_small, nir_small)
+    stats = _ndvi_summary(*_ndvi_sums(red, nir, red_scale, nir_scale), red.size)
+    return (ndvi_small,) + stats
+
+
+def _ndvi_from_segments(segments: Callable[[], Iterator[tuple]], h: int, w: int) -> tuple:
+    """Same as _ndvi_from_bands, but fed tile by tile from _iter_segment_bands.
+    The band scales depend on each band's peak, so `segments` is decoded twice: once for the
+    peaks, once for statistics and preview sums. Peak memory stays at a few tiles plus the preview.
+    """
+    red_peak = nir_peak = 0.0
+    for _, _, r, n in segments():
+        red_peak = max(red_peak, r.max())
+        nir_peak = max(nir_peak, n.max())
+    red_scale = _band_scale(red_peak)
+    nir_scale = _band_scale(nir_peak)
+    step = _preview_step(h, w)
+    red_small = np.zeros((-(-h // step), -(-w // step)), dtype=np.float32)
+    nir_small = np.zeros_like(red_small)
+    total = 0.0
+    valid = healthy = 0
+    for y, x, r, n in segments():
+        _add_block_sums(red_small, r, y, x, step)
+        _add_block_sums(nir_small, n, y, x, step)
+        t, v, hc = _ndvi_sums(r, n, red_scale, nir_scale)
+        total += t
+        valid += v
+        healthy += hc
+    counts = _block_counts(h, w, step)
+    red_small /= counts * red_scale
+    nir_small /= counts * nir_scale
+    ndvi_small = _ndvi_into(red_small, nir_small)
+    return (ndvi_small,) + _ndvi_summary(total, valid, healthy, h * w)
+
+
+def compute_ndvi_from_tif(tif_path: Path) -> Optional[dict]:
+    if tifffile is None:
+        return None
+    try:
+        with tifffile.TiffFile(str(tif_path)) as tf:
+            # Strategy 1: Multi-sample per pixel (H,W,C); decided from metadata before any pixels are read
+            series = tf.series[0]
+            red = nir = None
+            segments = None
+            guess = _guess_red_nir(tuple(series.shape))
+            if guess:
+                r_idx, n_idx = guess
+                page = series.pages[0] if len(series.pages) == 1 else None
+                if series.dataoffset is None and page is not None and _streamable(page):
+                    # Compressed/tiled: decode segment by segment instead of into one full-size array
+                    segments = lambda: _iter_segment_bands(page, page, r_idx, n_idx)  # noqa: E731
+                    height, width = page.shaped[2], page.shaped[3]
+                else:
+                    # Band views into the (possibly memory-mapped) pixels; nothing is copied here
+                    arr = _read_pixels(series, series.dataoffset is not None)
+                    red = arr[..., r_idx]
+                    nir = arr[..., n_idx]
+            # Strategy 2: Multi-page bands
+            if segments is None and (red is None or nir is None):
+                pages = tf.pages
+                labels = []
+                for i, p in enumerate(pages):
+                    desc = (getattr(p, 'description', '') or '').lower()
+                    name = ''
+                    try:
+                        name = str(p.tags.get('PageName', '').value).lower() if hasattr(p, 'tags') else ''
+                    except Exception:
+                        name = ''
+                    labels.append((i, desc + ' ' + name))
+                red_idx = next((i for i, s in labels if 'red' in s), None)
+                nir_idx = next((i for i, s in labels if 'nir' in s or 'near' in s), None)
+                if red_idx is not None and nir_idx is not None:
+                    red_page, nir_page = pages[red_idx], pages[nir_idx]
+                    if (not (red_page.is_contiguous and nir_page.is_contiguous)
+                            and _streamable(red_page) and red_page.shaped == nir_page.shaped
+                            and red_page.chunks == nir_page.chunks):
+                        # Same tiling in both pages, so their segments pair up position by position
+                        segments = lambda: _iter_segment_bands(red_page, nir_page)  # noqa: E731
+                        height, width = red_page.shaped[2], red_page.shaped[3]
+                    else:
+                        red = _read_pixels(red_page, bool(red_page.is_contiguous))
+                        nir = _read_pixels(nir_page, bool(nir_page.is_contiguous))
+            if segments is not None:
+                ndvi_small, mean_ndvi, healthy_pct = _ndvi_from_segments(segments, height, width)
+            elif red is not None and nir is not None:
+                ndvi_small, mean_ndvi, healthy_pct = _ndvi_from_bands(red, nir)
+            else:
+                return None
+            # Make a simple green colormap heatmap: quantize [-1,1] -> 0..255 and gather from the LUT
+            heat = ((ndvi_small + 1.0) * 127.5).astype(np.uint8)
+            rgb = _NDVI_LUT[heat]
+            return {"mean_ndvi": mean_ndvi, "healthy_pct": healthy_pct, "heatmap_rgb": rgb}
+    except Exception as e:
+        logging.exception("NDVI compute failed: %s", e)
+        return None
+
+
+# Heatmaps are regenerated previews; favour encode speed over a few percent of file size
+_HEATMAP_PNG_COMPRESS_LEVEL = 1
+
+def save_heatmap_png(rgb: np.ndarray, out_path: Path) -> None:
+    img = Image.fromarray(rgb, mode='RGB')
+    img.save(str(out_path), format='PNG', compress_level=_HEATMAP_PNG_COMPRESS_LEVEL)
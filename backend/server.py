@@ -1,24 +1,31 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, ReturnDocument
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
-from typing import List, Optional, Literal, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional, Dict, Any, AsyncIterator
+from enum import Enum
 import uuid
+import time
+import hashlib
+import asyncio
 from datetime import datetime, timezone
 import mimetypes
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import orjson
 
-# Light-weight raster utils (A)
 import numpy as np
-from PIL import Image
-try:
-    import tifffile
-except Exception:  # pragma: no cover
-    tifffile = None
+import aiofiles
+
+# Light-weight raster utils (A); kept in their own module for the NDVI process pool
+from ndvi import NDVI_ALGO_VERSION, compute_ndvi_from_tif, save_heatmap_png
 
 """
 Blue Carbon MRV & Registry (MVP++)
@@ -33,18 +40,30 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware so BSON timestamps come back as UTC-aware datetimes
+client = AsyncMongoClient(mongo_url, tz_aware=True)
 db = client[os.environ['DB_NAME']]
 
 UPLOAD_DIR = ROOT_DIR / 'uploads'
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-app = FastAPI()
+# When a fronting nginx serves the uploads directory, set e.g. UPLOADS_ACCEL_PREFIX=/_uploads/ with
+#   location /_uploads/ { internal; alias <backend>/uploads/; sendfile on; }
+# and /api/uploads/* only answers with an X-Accel-Redirect header; otherwise Starlette serves the bytes.
+UPLOADS_ACCEL_PREFIX = os.environ.get('UPLOADS_ACCEL_PREFIX')
+
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
-app.mount("/api/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
+if not UPLOADS_ACCEL_PREFIX:
+    app.mount("/api/uploads", StaticFiles(directory=str(UPLOAD_DIR)), name="uploads")
 
 # --------- Models ---------
-class PlantationDetails(BaseModel):
+class ImmutableModel(BaseModel):
+    # Unknown keys (e.g. Mongo's _id) are dropped without being stored; instances are never mutated
+    # after validation, which also makes shared ones (cached settings) safe to hand out
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+class PlantationDetails(ImmutableModel):
     area_hectares: float
     num_plants: int
     plantation_type: str
@@ -54,12 +73,25 @@ class PlantationDetails(BaseModel):
     data_source: Optional[str] = None  # Satellite/Drone/Specialized
     format_type: Optional[str] = None  # GeoTIFF/JPEG/JP2/HDF5/NetCDF
 
-class Project(BaseModel):
+class ProjectStatus(str, Enum):
+    submitted = 'submitted'
+    under_review = 'under_review'
+    approved = 'approved'
+    rejected = 'rejected'
+
+class ReviewDecision(str, Enum):
+    approve = 'approve'
+    reject = 'reject'
+
+class Project(ImmutableModel):
+    # Enum members are validated in pydantic-core; keep plain strings on the model for Mongo/JSON
+    model_config = ConfigDict(use_enum_values=True)
+
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     farmer_name: str
     details: PlantationDetails
     image_urls: List[str] = []  # uploaded assets (any format) served from /api/uploads
-    status: Literal['submitted', 'under_review', 'approved', 'rejected'] = 'submitted'
+    status: ProjectStatus = ProjectStatus.submitted
     # Core analysis
     growth_percent: Optional[float] = None
     ndvi_score: Optional[float] = None
@@ -76,26 +108,33 @@ class Project(BaseModel):
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
-class ProjectCreate(BaseModel):
+class ProjectCreate(ImmutableModel):
     farmer_name: str
     details: PlantationDetails
 
-class ProjectUpdate(BaseModel):
+class ProjectUpdate(ImmutableModel):
     details: Optional[PlantationDetails] = None
 
-class ReviewAction(BaseModel):
+class ReviewAction(ImmutableModel):
+    model_config = ConfigDict(use_enum_values=True)
+
     project_id: str
-    action: Literal['approve', 'reject']
+    action: ReviewDecision
     comments: Optional[str] = None
 
-class AdminSettings(BaseModel):
+class AdminSettings(ImmutableModel):
     token_price_usd: float = 10.0
     marketplace_enabled: bool = True
 
 DEFAULT_SETTINGS = AdminSettings()
+_DEFAULT_SETTINGS_DICT = DEFAULT_SETTINGS.model_dump()
+
+# List views: exactly the Project fields, no _id. Stored rows were written from validated
+# Project models, so the read path encodes them directly instead of re-validating each one.
+_PROJECT_LIST_PROJECTION = {"_id": 0, **{name: 1 for name in Project.model_fields}}
 
 # --------- Utils ---------
-async def parse_from_mongo(item: dict) -> dict:
+def parse_from_mongo(item: dict) -> dict:
     if not item:
         return item
     for k in ('created_at', 'updated_at'):
@@ -103,13 +142,71 @@ async def parse_from_mongo(item: dict) -> dict:
             item[k] = item[k].astimezone(timezone.utc).isoformat()
     return item
 
-async def get_settings() -> AdminSettings:
+# Admin settings change rarely; keep a short-lived in-process copy instead of a Mongo read per call
+_SETTINGS_TTL_SECONDS = 60.0
+_settings_cache: Optional[tuple] = None  # (fetched_at monotonic, AdminSettings)
+_settings_lock = asyncio.Lock()
+
+async def _load_settings() -> AdminSettings:
     row = await db.settings.find_one({"id": "admin_settings"})
     if not row:
-        await db.settings.insert_one({"id": "admin_settings", **DEFAULT_SETTINGS.dict()})
-        return DEFAULT_SETTINGS
+        # Seed lazily with an upsert so concurrent first reads cannot collide on the unique id index
+        row = await db.settings.find_one_and_update(
+            {"id": "admin_settings"},
+            {"$setOnInsert": _DEFAULT_SETTINGS_DICT},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
     return AdminSettings(**row)
 
+async def get_settings() -> AdminSettings:
+    global _settings_cache
+    cached = _settings_cache
+    if cached and time.monotonic() - cached[0] < _SETTINGS_TTL_SECONDS:
+        return cached[1]
+    async with _settings_lock:
+        # Another coroutine may have refreshed the cache while we waited for the lock
+        cached = _settings_cache
+        if cached and time.monotonic() - cached[0] < _SETTINGS_TTL_SECONDS:
+            return cached[1]
+        settings = await _load_settings()
+        _settings_cache = (time.monotonic(), settings)
+        return settings
+
+async def remember_settings(settings: AdminSettings) -> None:
+    # Write-through after an update so the next read in this process needs no Mongo round-trip.
+    # Under the lock, so a get_settings miss already reading the old row cannot store it over this one
+    global _settings_cache
+    async with _settings_lock:
+        _settings_cache = (time.monotonic(), settings)
+
+_STREAM_FLUSH_BYTES = 64 * 1024
+
+async def _iter_project_json(first: Optional[dict], cursor) -> AsyncIterator[bytes]:
+    buf = bytearray(b"[")
+    if first is not None:
+        buf += orjson.dumps(parse_from_mongo(first))
+        async for row in cursor:
+            buf += b","
+            buf += orjson.dumps(parse_from_mongo(row))
+            if len(buf) >= _STREAM_FLUSH_BYTES:
+                yield bytes(buf)
+                buf.clear()
+    buf += b"]"
+    yield bytes(buf)
+
+async def project_list_response(cursor) -> StreamingResponse:
+    """Stream a cursor of project rows as a JSON array.
+    The first row is awaited here, before the 200 goes out, so query errors still raise from the
+    handler; the rest of the batch is encoded as it is consumed. Returning a Response skips
+    FastAPI's response_model pass; the decorator's model is kept for OpenAPI.
+    """
+    try:
+        first = await anext(cursor)
+    except StopAsyncIteration:
+        first = None
+    return StreamingResponse(_iter_project_json(first, cursor), media_type="application/json")
+
 PREFIX = "/api/uploads/"
 
 def local_path_from_url(url: str) -> Optional[Path]:
@@ -118,205 +215,271 @@ def local_path_from_url(url: str) -> Optional[Path]:
     name = url[len(PREFIX):]
     return UPLOAD_DIR / name
 
-# ---- A & C: NDVI computation and heatmap ----
+_UPLOAD_NAME_HEX = 16  # uploads are stored as <sha256 prefix><ext>, see _save_upload
 
-def _guess_red_nir(arr: np.ndarray) -> Optional[tuple]:
-    """Try to guess (red_idx, nir_idx) given array shapes.
-    Supports: (H,W,4) RGBA-like where channel 0 or 2 is Red and last is NIR;
-              multi-page tiff where pages represent bands and page descriptions contain 'red'/'nir'.
-    Returns (red, nir) channel indices if found within last axis, else None.
-    """
-    if arr.ndim == 3:
-        h, w, c = arr.shape
-        if c >= 4:
-            # Try common orders
-            return (2, 3) if c >= 4 else None  # B,G,R,NIR (R=2, NIR=3) is common for some sensors
-        if c >= 3:
-            # If only RGB, we can't produce NDVI reliably
-            return None
-    return None
-
-
-def compute_ndvi_from_tif(tif_path: Path) -> Optional[dict]:
-    if tifffile is None:
-        return None
-    try:
-        with tifffile.TiffFile(str(tif_path)) as tf:
-            # Strategy 1: Multi-sample per pixel (H,W,C)
-            arr = tf.asarray()
-            red = nir = None
-            if isinstance(arr, np.ndarray) and arr.ndim == 3:
-                guess = _guess_red_nir(arr)
-                if guess:
-                    r_idx, n_idx = guess
-                    red = arr[..., r_idx].astype(np.float32)
-                    nir = arr[..., n_idx].astype(np.float32)
-            # Strategy 2: Multi-page bands
-            if red is None or nir is None:
-                pages = tf.pages
-                labels = []
-                for i, p in enumerate(pages):
-                    desc = (getattr(p, 'description', '') or '').lower()
-                    name = ''
-                    try:
-                        name = str(p.tags.get('PageName', '').value).lower() if hasattr(p, 'tags') else ''
-                    except Exception:
-                        name = ''
-                    labels.append((i, desc + ' ' + name))
-                red_idx = next((i for i, s in labels if 'red' in s), None)
-                nir_idx = next((i for i, s in labels if 'nir' in s or 'near' in s), None)
-                if red_idx is not None and nir_idx is not None:
-                    red = pages[red_idx].asarray().astype(np.float32)
-                    nir = pages[nir_idx].asarray().astype(np.float32)
-            if red is None or nir is None:
-                return None
-            # Normalize to 0..1 if necessary
-            if red.max() > 1.5:
-                red = red / 10000.0 if red.max() > 100.0 else red / 255.0
-            if nir.max() > 1.5:
-                nir = nir / 10000.0 if nir.max() > 100.0 else nir / 255.0
-            ndvi = (nir - red) / (nir + red + 1e-6)
-            # Clean
-            ndvi = np.clip(ndvi, -1.0, 1.0)
-            # Downscale for preview to keep memory light
-            step = max(1, int(max(ndvi.shape) / 1024))
-            ndvi_small = ndvi[::step, ::step]
-            # Healthy vegetation threshold ~ 0.3
-            healthy_pct = float(np.round((ndvi > 0.3).mean() * 100.0, 1))
-            mean_ndvi = float(np.round(np.nanmean(ndvi), 3))
-            # Make a simple green colormap heatmap
-            heat = ndvi_small.copy()
-            heat = (heat + 1.0) / 2.0  # map [-1,1] -> [0,1]
-            r = np.interp(heat, [0, 0.5, 1.0], [120, 240, 20])
-            g = np.interp(heat, [0, 0.5, 1.0], [60, 200, 180])
-            b = np.interp(heat, [0, 0.5, 1.0], [20, 80, 40])
-            rgb = np.dstack([r, g, b]).astype(np.uint8)
-            return {"mean_ndvi": mean_ndvi, "healthy_pct": healthy_pct, "heatmap_rgb": rgb}
-    except Exception as e:
-        logging.exception("NDVI compute failed: %s", e)
-        return None
+def file_content_key(path: Path) -> str:
+    """Full-content key for re-analysis. Content-addressed uploads reuse their SHA-256 name;
+    older uuid-named files are hashed in full (uploads are capped at 25MB)."""
+    stem = path.stem
+    if len(stem) == _UPLOAD_NAME_HEX and all(c in '0123456789abcdef' for c in stem):
+        return stem
+    with open(path, 'rb') as fh:
+        return hashlib.file_digest(fh, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+# ---- A & C: NDVI computation and heatmap (see ndvi.py) ----
+
+# Each uvicorn worker owns a pool, so keep it small; raise NDVI_POOL_WORKERS on single-worker deployments
+NDVI_POOL_WORKERS = max(1, int(os.environ.get('NDVI_POOL_WORKERS', '2')))
+
+_ndvi_pool: Optional[ProcessPoolExecutor] = None
 
+def get_ndvi_pool() -> ProcessPoolExecutor:
+    # Created on first use. Spawned (not forked) workers start clean instead of inheriting
+    # the event loop, driver state and executor threads of the API process, and only import ndvi.py.
+    global _ndvi_pool
+    if _ndvi_pool is None:
+        _ndvi_pool = ProcessPoolExecutor(max_workers=NDVI_POOL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _ndvi_pool
+
+def discard_ndvi_pool(pool: ProcessPoolExecutor) -> None:
+    # A dead worker (e.g. OOM-killed on a huge raster) breaks the executor for good; drop it so
+    # the next call builds a fresh one. Concurrent callers may already have replaced it.
+    global _ndvi_pool
+    if _ndvi_pool is pool:
+        _ndvi_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
 
-def save_heatmap_png(rgb: np.ndarray, out_path: Path) -> None:
-    img = Image.fromarray(rgb, mode='RGB')
-    img.save(str(out_path), format='PNG', compress_level=6)
 
 # --------- Basic ---------
 @api_router.get("/")
 async def root():
     return {"message": "Blue Carbon MRV API is alive"}
 
+# --------- Uploads via proxy (X-Accel-Redirect) ---------
+if UPLOADS_ACCEL_PREFIX:
+    @api_router.get("/uploads/{name}")
+    async def serve_upload(name: str):
+        # Dot-names cover traversal attempts and in-flight .part files
+        if name.startswith('.'):
+            raise HTTPException(status_code=404, detail="Not found")
+        return Response(headers={"X-Accel-Redirect": f"{UPLOADS_ACCEL_PREFIX}{name}"})
+
 # --------- Project CRUD ---------
+# List views return at most this many rows; matching batch size lets the server send them in one reply
+_LIST_LIMIT = 1000
+
 @api_router.post("/projects", response_model=Project)
 async def create_project(payload: ProjectCreate):
     project = Project(farmer_name=payload.farmer_name, details=payload.details)
-    await db.projects.insert_one(project.dict())
-    return project
+    # Timestamps are stored as BSON dates set by the server; the upsert returns them in the same round-trip
+    created = await db.projects.find_one_and_update(
+        {"id": project.id},
+        {
+            "$setOnInsert": project.model_dump(exclude={"created_at", "updated_at"}),
+            "$currentDate": {"created_at": True, "updated_at": True},
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return Project(**parse_from_mongo(created))
 
 @api_router.get("/projects", response_model=List[Project])
 async def list_projects(status: Optional[str] = None):
     query = {"status": status} if status else {}
-    rows = await db.projects.find(query).sort("created_at", -1).to_list(1000)
-    return [Project(**(await parse_from_mongo(r))) for r in rows]
+    cursor = db.projects.find(query, _PROJECT_LIST_PROJECTION).sort("created_at", -1).limit(_LIST_LIMIT).batch_size(_LIST_LIMIT)
+    return await project_list_response(cursor)
 
 @api_router.get("/projects/{project_id}", response_model=Project)
 async def get_project(project_id: str):
     row = await db.projects.find_one({"id": project_id})
     if not row:
         raise HTTPException(status_code=404, detail="Project not found")
-    return Project(**(await parse_from_mongo(row)))
+    return Project(**parse_from_mongo(row))
 
 @api_router.patch("/projects/{project_id}", response_model=Project)
 async def update_project(project_id: str, payload: ProjectUpdate):
-    row = await db.projects.find_one({"id": project_id})
-    if not row:
-        raise HTTPException(status_code=404, detail="Project not found")
     update_fields = {}
     if payload.details is not None:
-        update_fields["details"] = payload.details.dict()
+        update_fields["details"] = payload.details.model_dump()
     if update_fields:
-        update_fields["updated_at"] = datetime.now(timezone.utc).isoformat()
-        await db.projects.update_one({"id": project_id}, {"$set": update_fields})
-    updated = await db.projects.find_one({"id": project_id})
-    return Project(**(await parse_from_mongo(updated)))
+        updated = await db.projects.find_one_and_update(
+            {"id": project_id},
+            {"$set": update_fields, "$currentDate": {"updated_at": True}},
+            return_document=ReturnDocument.AFTER,
+        )
+    else:
+        updated = await db.projects.find_one({"id": project_id})
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return Project(**parse_from_mongo(updated))
 
 # --------- Upload (multi-format) ---------
-_ALLOWED_MIME = {
+_ALLOWED_MIME = frozenset({
     # images
     "image/jpeg", "image/png", "image/jpg", "image/tiff", "image/tif", "image/jp2",
     # geospatial / scientific
     "application/geotiff", "image/geotiff", "application/x-geotiff",
     "application/octet-stream", "application/x-hdf", "application/x-hdf5", "application/netcdf",
     "application/x-netcdf", "application/vnd.las", "application/x-las",
+})
+_ALLOWED_EXT = frozenset({".jpg", ".jpeg", ".png", ".tif", ".tiff", ".jp2", ".geotiff", ".hdf", ".h5", ".nc"})
+# Resolved once so the common extensions never go through mimetypes.guess_type per file
+_EXT_TO_MIME = {
+    ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".jp2": "image/jp2",
+    ".tif": "image/tiff", ".tiff": "image/tiff", ".geotiff": "image/geotiff",
+    ".hdf": "application/x-hdf", ".h5": "application/x-hdf5", ".nc": "application/x-netcdf",
 }
-_ALLOWED_EXT = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".jp2", ".geotiff", ".hdf", ".h5", ".nc"}
+# Leading-byte signatures -> (mime, stored extension); consulted only when the declared type and
+# extension are both rejected, so a mislabelled but valid file is still accepted
+_MAGIC_SIGNATURES = (
+    (b"\xff\xd8\xff", ("image/jpeg", ".jpg")),
+    (b"\x89PNG\r\n\x1a\n", ("image/png", ".png")),
+    (b"II*\x00", ("image/tiff", ".tif")),
+    (b"MM\x00*", ("image/tiff", ".tif")),
+    (b"II+\x00", ("image/tiff", ".tif")),  # BigTIFF
+    (b"MM\x00+", ("image/tiff", ".tif")),
+    (b"\x00\x00\x00\x0cjP  \r\n\x87\n", ("image/jp2", ".jp2")),
+    (b"\x89HDF\r\n\x1a\n", ("application/x-hdf5", ".h5")),  # also NetCDF-4
+    (b"\x0e\x03\x13\x01", ("application/x-hdf", ".hdf")),
+    (b"CDF\x01", ("application/x-netcdf", ".nc")),
+    (b"CDF\x02", ("application/x-netcdf", ".nc")),
+    (b"CDF\x05", ("application/x-netcdf", ".nc")),
+    (b"LASF", ("application/vnd.las", ".bin")),
+)
+_SNIFF_BYTES = 16
+_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+_UPLOAD_CHUNK_SIZE = 1 << 20
+
+def sniff_upload_type(head: bytes) -> Optional[tuple]:
+    return next((kind for sig, kind in _MAGIC_SIGNATURES if head.startswith(sig)), None)
+
+def _commit_upload(tmp: Path, dest: Path) -> None:
+    # Identical content already stored under this name: keep the existing file
+    if dest.exists():
+        tmp.unlink(missing_ok=True)
+    else:
+        os.replace(tmp, dest)
+
+async def _validated_ext(f: UploadFile) -> str:
+    """Return the extension to store `f` under, or raise 400 if its type or size is not accepted."""
+    # The multipart parser has already spooled the file, so its size is known before any write
+    if f.size is not None and f.size > _MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=400, detail="File too large (25MB max)")
+    ext = os.path.splitext(f.filename or "")[1].lower()
+    ct = (f.content_type or _EXT_TO_MIME.get(ext)
+          or mimetypes.guess_type(f.filename or "")[0] or "application/octet-stream")
+    if ct in _ALLOWED_MIME or ext in _ALLOWED_EXT:
+        return ext if ext in _ALLOWED_EXT else ".bin"
+    # Declared type and name both miss: sniff the header before any bytes are written
+    sniffed = sniff_upload_type(await f.read(_SNIFF_BYTES))
+    if not sniffed:
+        raise HTTPException(status_code=400, detail=f"Unsupported type {ct}")
+    await f.seek(0)
+    return sniffed[1]
+
+async def _save_upload(f: UploadFile, safe_ext: str) -> str:
+    tmp = UPLOAD_DIR / f".upload_{uuid.uuid4()}.part"
+    committed = False
+    try:
+        # Stream to disk in chunks so a large upload never sits in memory as one bytes object,
+        # hashing as we go so the final name is content-addressed
+        total = 0
+        digest = hashlib.sha256()
+        async with aiofiles.open(tmp, 'wb') as out:
+            while chunk := await f.read(_UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > _MAX_UPLOAD_BYTES:  # backstop for a size the parser did not report
+                    raise HTTPException(status_code=400, detail="File too large (25MB max)")
+                digest.update(chunk)
+                await out.write(chunk)
+        fname = f"{digest.hexdigest()[:_UPLOAD_NAME_HEX]}{safe_ext}"
+        await asyncio.to_thread(_commit_upload, tmp, UPLOAD_DIR / fname)
+        committed = True
+        return f"/api/uploads/{fname}"
+    finally:
+        # Rejected, failed or cancelled (a sibling upload failed): never leave the .part file behind
+        if not committed:
+            await asyncio.to_thread(tmp.unlink, missing_ok=True)
 
 @api_router.post("/projects/{project_id}/upload")
 async def upload_files(project_id: str, files: List[UploadFile] = File(...)):
-    row = await db.projects.find_one({"id": project_id})
-    if not row:
+    # Existence check only; the document itself is never needed now that URLs are appended atomically
+    if not await db.projects.count_documents({"id": project_id}, limit=1):
         raise HTTPException(status_code=404, detail="Project not found")
 
-    saved_urls: List[str] = []
-    for f in files:
-        ct = f.content_type or mimetypes.guess_type(f.filename or "")[0] or "application/octet-stream"
-        if ct not in _ALLOWED_MIME:
-            ext = os.path.splitext(f.filename or "")[1].lower()
-            if ext not in _ALLOWED_EXT:
-                raise HTTPException(status_code=400, detail=f"Unsupported type {ct}")
-        name_ext = os.path.splitext(f.filename or "")[1] or ".bin"
-        safe_ext = name_ext.lower() if name_ext.lower() in _ALLOWED_EXT else ".bin"
-        fname = f"{project_id}_{uuid.uuid4()}{safe_ext}"
-        dest = UPLOAD_DIR / fname
-        content = await f.read()
-        if len(content) > 25 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="File too large (25MB max)")
-        with open(dest, 'wb') as out:
-            out.write(content)
-        saved_urls.append(f"/api/uploads/{fname}")
-
-    new_urls = (row.get('image_urls') or []) + saved_urls
-    await db.projects.update_one({"id": project_id}, {"$set": {"image_urls": new_urls, "updated_at": datetime.now(timezone.utc).isoformat()}})
+    # Validate every file (type and size) first so a rejected file never leaves siblings committed
+    exts = [await _validated_ext(f) for f in files]
+    # TaskGroup cancels the sibling saves as soon as one fails, so nothing more gets committed
+    try:
+        async with asyncio.TaskGroup() as tg:
+            saves = [tg.create_task(_save_upload(f, e)) for f, e in zip(files, exts)]
+    except* HTTPException as eg:
+        raise eg.exceptions[0]
+    saved_urls: List[str] = [t.result() for t in saves]
+
+    # Append server-side so concurrent uploads to the same project cannot overwrite each other;
+    # $addToSet keeps a re-uploaded (same content) file from being listed twice
+    await db.projects.update_one(
+        {"id": project_id},
+        {"$addToSet": {"image_urls": {"$each": saved_urls}}, "$currentDate": {"updated_at": True}},
+    )
     return {"uploaded": saved_urls}
 
 # --------- Analyze (A, B, C, D-ready) ---------
+_TIFF_EXTS = frozenset({'.tif', '.tiff', '.geotiff'})
+# Extension -> (data_source, format_type), in detection priority order: first match wins
+_SOURCE_FORMAT_BY_EXT = {
+    '.tif': ('Satellite', 'GeoTIFF'), '.tiff': ('Satellite', 'GeoTIFF'), '.geotiff': ('Satellite', 'GeoTIFF'),
+    '.hdf': ('Specialized', 'HDF5'), '.h5': ('Specialized', 'HDF5'),
+    '.nc': ('Specialized', 'NetCDF'),
+    '.jpg': ('Drone', 'JPEG/PNG'), '.jpeg': ('Drone', 'JPEG/PNG'), '.png': ('Drone', 'JPEG/PNG'),
+}
+
 @api_router.post("/projects/{project_id}/analyze", response_model=Project)
 async def analyze_project(project_id: str):
     row = await db.projects.find_one({"id": project_id})
     if not row:
         raise HTTPException(status_code=404, detail="Project not found")
 
+    # Parse each upload URL once: (url, local path or None, lowercase suffix)
+    urls = row.get('image_urls') or []
+    uploads = [(u, local_path_from_url(u), Path(u).suffix.lower()) for u in urls]
+
     # Auto-detect source/format if absent (B)
     details = row.get('details', {})
     ds = details.get('data_source')
     ft = details.get('format_type')
     if (not ds) or (not ft):
-        ext_seen = {Path(local_path_from_url(u)).suffix.lower() for u in (row.get('image_urls') or []) if local_path_from_url(u)}
-        if any(e in ext_seen for e in {'.tif', '.tiff', '.geotiff'}):
-            ds = ds or 'Satellite'
-            ft = ft or 'GeoTIFF'
-        elif any(e in ext_seen for e in {'.hdf', '.h5'}):
-            ds = ds or 'Specialized'
-            ft = ft or 'HDF5'
-        elif any(e in ext_seen for e in {'.nc'}):
-            ds = ds or 'Specialized'
-            ft = ft or 'NetCDF'
-        elif any(e in ext_seen for e in {'.jpg', '.jpeg', '.png'}):
-            ds = ds or 'Drone'
-            ft = ft or 'JPEG/PNG'
+        ext_seen = {suffix for _, path, suffix in uploads if path}
+        detected = next((_SOURCE_FORMAT_BY_EXT[e] for e in _SOURCE_FORMAT_BY_EXT if e in ext_seen), None)
+        if detected:
+            ds = ds or detected[0]
+            ft = ft or detected[1]
         details['data_source'] = ds
         details['format_type'] = ft
 
-    # Try NDVI from first GeoTIFF (A)
+    # Try NDVI from first GeoTIFF (A); identical content reuses the stored result and heatmap
     ndvi_result = None
-    tif_url = next((u for u in (row.get('image_urls') or []) if (Path(u).suffix.lower() in {'.tif', '.tiff', '.geotiff'})), None)
-    if tif_url:
-        tif_path = local_path_from_url(tif_url)
-        if tif_path and tif_path.exists():
-            ndvi_result = compute_ndvi_from_tif(tif_path)
+    tif_hash = None
+    tif_path = next((path for _, path, suffix in uploads if suffix in _TIFF_EXTS), None)
+    if tif_path and tif_path.exists():
+        tif_hash = await asyncio.to_thread(file_content_key, tif_path)
+        cached = await db.ndvi_cache.find_one({"hash": tif_hash, "algo_version": NDVI_ALGO_VERSION}, {"_id": 0})
+        cached_png = local_path_from_url(cached.get('ndvi_map_url')) if cached else None
+        if cached_png and cached_png.exists():
+            ndvi_result = cached
+        else:
+            # Raster decode + NDVI is CPU-bound; run it in a worker process, not on the event loop
+            pool = get_ndvi_pool()
+            try:
+                ndvi_result = await asyncio.get_running_loop().run_in_executor(pool, compute_ndvi_from_tif, tif_path)
+            except BrokenProcessPool:
+                # Same fallback as a failed compute: analyze continues on the base signals
+                logging.exception("NDVI worker pool broke on %s; recreating it", tif_path.name)
+                discard_ndvi_pool(pool)
 
     # Fallback base signals
-    img_count = len(row.get('image_urls') or [])
+    img_count = len(urls)
     base = max(0.2, min(0.9, 0.3 + 0.1 * img_count))
     ndvi = float(np.round((ndvi_result['mean_ndvi'] if ndvi_result else base), 3))
     growth = float(np.round(base * 100, 2))
@@ -330,19 +493,29 @@ async def analyze_project(project_id: str):
 
     ndvi_map_url = row.get('ndvi_map_url')
     if ndvi_result and 'heatmap_rgb' in ndvi_result:
-        out_png = UPLOAD_DIR / f"ndvi_{project_id}.png"
+        out_png = UPLOAD_DIR / f"ndvi_{tif_hash}_v{NDVI_ALGO_VERSION}.png"
         try:
-            save_heatmap_png(ndvi_result['heatmap_rgb'], out_png)
+            # PNG encode + write is blocking disk/CPU work; keep it off the event loop
+            await asyncio.to_thread(save_heatmap_png, ndvi_result['heatmap_rgb'], out_png)
             ndvi_map_url = f"/api/uploads/{out_png.name}"
+            # One row per content hash (unique index): an older version's row is replaced in place
+            await db.ndvi_cache.update_one(
+                {"hash": tif_hash},
+                {"$set": {"algo_version": NDVI_ALGO_VERSION, "mean_ndvi": ndvi_result['mean_ndvi'],
+                          "healthy_pct": ndvi_result['healthy_pct'], "ndvi_map_url": ndvi_map_url}},
+                upsert=True,
+            )
         except Exception as e:
             logging.exception("Failed to save NDVI heatmap: %s", e)
+    elif ndvi_result:
+        ndvi_map_url = ndvi_result['ndvi_map_url']
 
     updates: Dict[str, Any] = {
         "details": details,
         "ndvi_score": ndvi,
         "growth_percent": growth,
         "co2_tonnes": co2,
-        "status": "under_review",
+        "status": ProjectStatus.under_review.value,
         "quality_notes": "Auto-analysis complete. Awaiting verifier review.",
         "mean_ndvi": ndvi,
         "healthy_pct": healthy_pct,
@@ -351,32 +524,39 @@ async def analyze_project(project_id: str):
         "price_per_token_usd": settings.token_price_usd,
         "maturity_pct": maturity_pct,
         "ndvi_map_url": ndvi_map_url,
-        "updated_at": datetime.now(timezone.utc).isoformat(),
     }
-    await db.projects.update_one({"id": project_id}, {"$set": updates})
-    updated = await db.projects.find_one({"id": project_id})
-    return Project(**(await parse_from_mongo(updated)))
+    updated = await db.projects.find_one_and_update(
+        {"id": project_id},
+        {"$set": updates, "$currentDate": {"updated_at": True}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return Project(**parse_from_mongo(updated))
 
 # --------- Verifier ---------
 @api_router.get("/verifier/projects", response_model=List[Project])
 async def list_pending_for_verifier():
-    rows = await db.projects.find({"status": {"$in": ["submitted", "under_review"]}}).sort("updated_at", -1).to_list(1000)
-    return [Project(**(await parse_from_mongo(r))) for r in rows]
+    query = {"status": {"$in": [ProjectStatus.submitted.value, ProjectStatus.under_review.value]}}
+    cursor = db.projects.find(query, _PROJECT_LIST_PROJECTION).sort("updated_at", -1).limit(_LIST_LIMIT).batch_size(_LIST_LIMIT)
+    return await project_list_response(cursor)
 
 @api_router.post("/verifier/review", response_model=Project)
 async def verifier_review(action: ReviewAction):
-    row = await db.projects.find_one({"id": action.project_id})
-    if not row:
-        raise HTTPException(status_code=404, detail="Project not found")
-    new_status = "approved" if action.action == "approve" else "rejected"
+    approved = action.action == ReviewDecision.approve
+    new_status = ProjectStatus.approved.value if approved else ProjectStatus.rejected.value
     updates = {
         "status": new_status,
-        "quality_notes": action.comments or ("Verified and approved" if new_status == "approved" else "Rejected by verifier"),
-        "updated_at": datetime.now(timezone.utc).isoformat(),
+        "quality_notes": action.comments or ("Verified and approved" if approved else "Rejected by verifier"),
     }
-    await db.projects.update_one({"id": action.project_id}, {"$set": updates})
-    updated = await db.projects.find_one({"id": action.project_id})
-    return Project(**(await parse_from_mongo(updated)))
+    updated = await db.projects.find_one_and_update(
+        {"id": action.project_id},
+        {"$set": updates, "$currentDate": {"updated_at": True}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return Project(**parse_from_mongo(updated))
 
 # --------- Admin ---------
 @api_router.get("/admin/settings", response_model=AdminSettings)
@@ -385,7 +565,8 @@ async def get_admin_settings():
 
 @api_router.post("/admin/settings", response_model=AdminSettings)
 async def set_admin_settings(settings: AdminSettings):
-    await db.settings.update_one({"id": "admin_settings"}, {"$set": settings.dict()}, upsert=True)
+    await db.settings.update_one({"id": "admin_settings"}, {"$set": settings.model_dump()}, upsert=True)
+    await remember_settings(settings)
     return settings
 
 # --------- Report JSON (B, C) ---------
@@ -467,6 +648,18 @@ app.add_middleware(
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def ensure_indexes():
+    # Every endpoint looks projects up by `id`; list views filter/sort on status + timestamps
+    await db.projects.create_index("id", unique=True)
+    await db.projects.create_index([("status", 1), ("updated_at", -1)])
+    await db.projects.create_index([("status", 1), ("created_at", -1)])
+    await db.projects.create_index([("created_at", -1)])
+    await db.settings.create_index("id", unique=True)
+    await db.ndvi_cache.create_index("hash", unique=True)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await client.close()
+    if _ndvi_pool is not None:
+        _ndvi_pool.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
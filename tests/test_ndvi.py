@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import ndvi  # noqa: E402
+
+
+def test_block_mean_keeps_partial_edge_blocks():
+    band = np.arange(3 * 10, dtype=np.uint16).reshape(3, 10)
+    out = ndvi._block_mean(band, 4)
+    assert out.shape == (1, 3)
+    assert np.allclose(out, [[band[:, 0:4].mean(), band[:, 4:8].mean(), band[:, 8:10].mean()]])
+
+
+def test_thin_strip_tif_gives_non_empty_heatmap(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    path = tmp_path / 'strip.tif'
+    data = np.zeros((3, 5000, 4), dtype=np.uint16)
+    data[..., 2] = 1000
+    data[..., 3] = 3000
+    tifffile.imwrite(str(path), data, photometric='rgb', extrasamples=['unassalpha'])
+    result = ndvi.compute_ndvi_from_tif(path)
+    assert result is not None
+    assert result['heatmap_rgb'].shape == (1, 1250, 3)
+    assert result['mean_ndvi'] == 0.5
+    ndvi.save_heatmap_png(result['heatmap_rgb'], tmp_path / 'heat.png')
+
+
+def test_tiled_compressed_tif_matches_uncompressed(tmp_path):
+    tifffile = pytest.importorskip('tifffile')
+    rng = np.random.default_rng(0)
+    # Width 3100 gives a preview step of 3, so 256-px tiles straddle preview blocks
+    data = rng.integers(0, 10000, size=(300, 3100, 4), dtype=np.uint16)
+    plain, tiled = tmp_path / 'plain.tif', tmp_path / 'tiled.tif'
+    tifffile.imwrite(str(plain), data, photometric='rgb', extrasamples=['unassalpha'])
+    tifffile.imwrite(str(tiled), data, tile=(256, 256), compression='zlib', photometric='rgb', extrasamples=['unassalpha'])
+    a = ndvi.compute_ndvi_from_tif(plain)
+    b = ndvi.compute_ndvi_from_tif(tiled)
+    assert (a['mean_ndvi'], a['healthy_pct']) == (b['mean_ndvi'], b['healthy_pct'])
+    assert a['heatmap_rgb'].shape == b['heatmap_rgb'].shape == (100, 1034, 3)
+    assert np.abs(a['heatmap_rgb'].astype(int) - b['heatmap_rgb']).max() <= 1
@@ -0,0 +1,49 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import server  # noqa: E402
+
+
+class _Projects:
+    def __init__(self):
+        self.updates = []
+
+    async def count_documents(self, query, limit=0):
+        return 1
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append(update)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    db = type('DB', (), {})()
+    db.projects = _Projects()
+    monkeypatch.setattr(server, 'db', db)
+    monkeypatch.setattr(server, 'UPLOAD_DIR', tmp_path)
+    monkeypatch.setattr(server, '_MAX_UPLOAD_BYTES', 1024)
+    return TestClient(server.app)
+
+
+def test_oversize_file_rejects_the_whole_upload_before_any_write(client, tmp_path):
+    files = [
+        ('files', ('photo.jpg', b'\xff\xd8\xff' + b'\0' * 100, 'image/jpeg')),
+        ('files', ('scene.tif', b'II*\x00' + b'\0' * 2048, 'image/tiff')),
+    ]
+    r = client.post('/api/projects/p1/upload', files=files)
+    assert r.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+    assert server.db.projects.updates == []
+
+
+def test_upload_is_stored_content_addressed(client, tmp_path):
+    r = client.post('/api/projects/p1/upload', files=[('files', ('photo.jpg', b'\xff\xd8\xff' + b'\0' * 100, 'image/jpeg'))])
+    assert r.status_code == 200
+    [url] = r.json()['uploaded']
+    assert [p.name for p in tmp_path.iterdir()] == [url.rsplit('/', 1)[1]]